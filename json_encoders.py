@@ -1,16 +1,64 @@
 """Class that pretty-prints QMK info.json files.
 """
 import json
+from collections import OrderedDict
 from decimal import Decimal
+from json.encoder import encode_basestring_ascii, encode_basestring, INFINITY, c_make_encoder, _make_iterencode
+from operator import itemgetter
 
 newline = '\n'
 
+_CONTAINERS = (list, tuple, dict)
+_CONTAINER_SET = frozenset(_CONTAINERS + (OrderedDict,))
+_SCALAR_SET = frozenset((str, int, float, bool, type(None)))
+_sort_key = itemgetter(0)
+_KEY_CACHE_SIZE = 1024
+_BOOL_STRS = {True: 'true', False: 'false'}
+
+# Sort prefixes for info.json keys, keyed on (indentation level, key). Forces layout to the back of the sort order.
+_INFO_ORDER = {
+    (1, 'manufacturer'): '10keyboard_name',
+    (1, 'keyboard_name'): '11keyboard_name',
+    (1, 'maintainer'): '12maintainer',
+    (1, 'processor'): '13processor',
+    (1, 'bootloader'): '14bootloader',
+    (1, 'usb'): '15usb',
+    (1, 'features'): '16bootloader',
+    (1, 'community_layouts'): '97community_layouts',
+    (1, 'layout_aliases'): '98layout_aliases',
+    (1, 'layouts'): '99layouts',
+    # Sorting USB
+    (2, 'vid'): '10vid',
+    (2, 'pid'): '11pid',
+    (2, 'device_ver'): '12device_ver',
+}
+
+# Sort prefixes for keymap.json keys, keyed on (indentation level, key).
+_KEYMAP_ORDER = {
+    (1, 'version'): '00version',
+    (1, 'author'): '01author',
+    (1, 'notes'): '02notes',
+    (1, 'layers'): '98layers',
+    (1, 'documentation'): '99documentation',
+}
+
+
+def _split_levels(order):
+    """Splits a (level, key) sort order into a {level: {key: prefix}} lookup, so each dict only picks its table once.
+    """
+    tables = {}
+
+    for (level, key), prefix in order.items():
+        tables.setdefault(level, {})[key] = prefix
+
+    return tables
+
 
 class QMKJSONEncoder(json.JSONEncoder):
     """Base class for all QMK JSON encoders.
     """
-    container_types = (list, tuple, dict)
     indentation_char = " "
+    sort_tables = {}
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -19,210 +67,338 @@ class QMKJSONEncoder(json.JSONEncoder):
         if not self.indent:
             self.indent = 4
 
+        # Indent strings by level, grown one step at a time as deeper levels are reached.
+        self._indent_step = self.indentation_char * self.indent
+        self._indent_cache = [""]
+        self._key_cache = {}
+
+        # Encoders keyed on the exact type of the object, so that the common cases skip the isinstance() chain.
+        # Scalars are encoded to a string, containers are written out piece by piece (see encode_to()).
+        # JSONEncoder.encode() only has a shortcut for strings, so scalars use the stock encoder's primitives directly.
+        self._enc_dispatch = {
+            str: encode_basestring_ascii if self.ensure_ascii else encode_basestring,
+            int: int.__repr__,
+            float: self.encode_float,
+            bool: _BOOL_STRS.__getitem__,
+            type(None): lambda obj: 'null',
+            Decimal: self.encode_decimal,
+        }
+        self._write_dispatch = {
+            list: self.encode_list,
+            tuple: self.encode_list,
+        }
+
+        if hasattr(self, 'encode_dict'):
+            self._write_dispatch[dict] = self._write_dispatch[OrderedDict] = self.encode_dict
+
     def encode_decimal(self, obj):
         """Encode a decimal object.
         """
-        if obj == int(obj):  # I can't believe Decimal objects don't have .is_integer()
-            return int(obj)
+        # A non-negative exponent means there are no digits after the point
+        if obj.is_finite() and obj.as_tuple().exponent >= 0:
+            return str(int(obj))
+
+        integral = int(obj)  # Still raises for NaN and Infinity
+
+        if obj == integral:  # I can't believe Decimal objects don't have .is_integer()
+            return str(integral)
+
+        return str(float(obj))
+
+    def encode_float(self, obj):
+        """Encode a float, same as the stock encoder.
+        """
+        if obj != obj or obj == INFINITY or obj == -INFINITY:
+            # Let the stock encoder deal with NaN and Infinity, including allow_nan
+            return super().encode(obj)
 
-        return float(obj)
+        return float.__repr__(obj)
 
-    def encode_list(self, obj):
+    def encode_list(self, obj, write):
         """Encode a list-like object.
         """
-        if self.primitives_only(obj):
-            return "[" + ", ".join(self.encode(element) for element in obj) + "]"
+        if not obj:
+            write("[]")
+            return
+
+        encode = self.encode
+        encoders = self._enc_dispatch
+        containers = _CONTAINER_SET
+        output = []
+        append = output.append
+
+        # Encode on a single line until we find a container (list, tuple, dict)
+        for element in obj:
+            element_type = type(element)
+
+            if element_type in containers:
+                break
+
+            encoder = encoders.get(element_type)
+
+            if encoder is not None:
+                append(encoder(element))
+
+            # Subclasses (namedtuple, defaultdict, ...) need isinstance() to be recognised as containers
+            elif isinstance(element, _CONTAINERS):
+                break
+
+            else:
+                append(encode(element))
 
         else:
-            self.indentation_level += 1
-            output = [self.indent_str + self.encode(element) for element in obj]
-            self.indentation_level -= 1
+            write("[" + ", ".join(output) + "]")
+            return
+
+        encode_to = self.encode_to
+        self.indentation_level += 1
+        indent = self.indent_str
+        separator = ",\n" + indent
+        write("[\n" + indent)
 
-            return "[\n" + ",\n".join(output) + "\n" + self.indent_str + "]"
+        for i, element in enumerate(obj):
+            if i:
+                write(separator)
+
+            encode_to(element, write)
+
+        self.indentation_level -= 1
+        write("\n" + self.indent_str + "]")
 
     def encode(self, obj):
         """Encode keymap.json objects for QMK.
         """
-        if isinstance(obj, Decimal):
-            return self.encode_decimal(obj)
+        encoder = self._enc_dispatch.get(type(obj))
+
+        if encoder is not None:
+            return encoder(obj)
+
+        output = []
+        self.encode_to(obj, output.append)
+
+        return "".join(output)
+
+    def encode_to(self, obj, write):
+        """Encode an object, passing each piece of the output to write() instead of building intermediate strings.
+        """
+        obj_type = type(obj)
+        encoder = self._enc_dispatch.get(obj_type)
+
+        if encoder is not None:
+            write(encoder(obj))
+            return
+
+        writer = self._write_dispatch.get(obj_type)
+
+        if writer is not None:
+            writer(obj, write)
+
+        # Only subclasses of the types above get this far, so these need isinstance()
+        elif isinstance(obj, Decimal):
+            write(self.encode_decimal(obj))
 
         elif isinstance(obj, (list, tuple)):
-            return self.encode_list(obj)
+            self.encode_list(obj, write)
 
         elif isinstance(obj, dict):
-            return self.encode_dict(obj)
+            self.encode_dict(obj, write)
 
         else:
-            return super().encode(obj)
+            write(super().encode(obj))
 
-    def primitives_only(self, obj):
-        """Returns true if the object doesn't have any container type objects (list, tuple, dict).
+    def write_dict_items(self, obj, write):
+        """Write a non-empty dictionary with one item per line, in sorted_items() order.
         """
-        if isinstance(obj, dict):
-            obj = obj.values()
+        encode_to = self.encode_to
+        encoders = self._enc_dispatch
+        key_cache = self._key_cache
+        self.indentation_level += 1
+        indent = self.indent_str
+        separator = ",\n" + indent
+        items = self.sorted_items(obj)
+        write("{\n" + indent)
 
-        return not any(isinstance(element, self.container_types) for element in obj)
+        for i, (key, value) in enumerate(items):
+            if i:
+                write(separator)
 
-    @property
-    def indent_str(self):
-        return self.indentation_char * (self.indentation_level * self.indent)
+            encoded_key = key_cache.get(key)
 
+            if encoded_key is None:
+                encoded_key = self.encode_key(key)
 
-class InfoJSONEncoder(QMKJSONEncoder):
-    """Custom encoder to make info.json's a little nicer to work with.
-    """
-    def encode_dict(self, obj):
-        """Encode info.json dictionaries.
-        """
-        if obj:
-            if self.indentation_level == 4:
-                # These are part of a layout, put them on a single line.
-                return "{ " + ", ".join(f"{self.encode(key)}: {self.encode(element)}" for key, element in sorted(obj.items())) + " }"
+            encoder = encoders.get(type(value))
+
+            if encoder is not None:
+                write(encoded_key + ": " + encoder(value))
 
             else:
-                self.indentation_level += 1
-                output = [self.indent_str + f"{json.dumps(key)}: {self.encode(value)}" for key, value in sorted(obj.items(), key=self.sort_dict)]
-                self.indentation_level -= 1
-                return "{\n" + ",\n".join(output) + "\n" + self.indent_str + "}"
-        else:
-            return "{}"
+                write(encoded_key + ": ")
+                encode_to(value, write)
+
+        self.indentation_level -= 1
+        write("\n" + self.indent_str + "}")
 
-    def sort_dict(self, key):
-        """Forces layout to the back of the sort order.
+    def encode_key(self, key):
+        """Encode a dictionary key.
+
+        String keys are cached, since the same handful of keys ("x", "y", "matrix", ...) repeat throughout a file.
         """
-        key = key[0]
+        encoded_key = json.dumps(key)
 
-        if self.indentation_level == 1:
-            if key == 'manufacturer':
-                return '10keyboard_name'
+        if type(key) is str and len(self._key_cache) < _KEY_CACHE_SIZE:
+            self._key_cache[key] = encoded_key
 
-            elif key == 'keyboard_name':
-                return '11keyboard_name'
+        return encoded_key
 
-            elif key == 'maintainer':
-                return '12maintainer'
+    def sorted_items(self, obj):
+        """Returns the (key, value) pairs of a dictionary in the order they should be written.
 
-            elif key == 'processor':
-                return '13processor'
+        Sort keys are computed once per item from sort_table(), so the sort itself compares them in C.
+        """
+        table, prefix = self.sort_table()
 
-            elif key == 'bootloader':
-                return '14bootloader'
+        if not table and prefix is None:
+            # Nothing to reorder at this level, so sort on the keys themselves without decorating
+            return sorted(obj.items(), key=_sort_key)
 
-            elif key == 'usb':
-                return '15usb'
+        elif prefix is None:
+            decorated = [(table.get(item[0], item[0]), item) for item in obj.items()]
+        else:
+            decorated = [(table.get(item[0], prefix + str(item[0])), item) for item in obj.items()]
 
-            elif key == 'features':
-                return '16bootloader'
+        decorated.sort(key=_sort_key)
 
-            elif key == 'community_layouts':
-                return '97community_layouts'
+        return [item for _, item in decorated]
 
-            elif key == 'layout_aliases':
-                return '98layout_aliases'
+    def sort_table(self):
+        """Returns the sort prefixes for dict keys at the current indentation level, and the prefix for keys not in it.
 
-            elif key == 'layouts':
-                return '99layouts'
+        Keys missing from the table go in the middle at the top level, and sort as-is further down.
+        """
+        level = self.indentation_level
 
-            else:
-                return '50' + str(key)
+        return self.sort_tables.get(level, {}), '50' if level == 1 else None
 
-        # Sorting USB
-        elif self.indentation_level == 2:
-            if key == 'vid':
-                return '10vid'
+    def indent_at(self, level):
+        """Returns the indentation string for a given level.
+        """
+        cache = self._indent_cache
 
-            elif key == 'pid':
-                return '11pid'
+        while len(cache) <= level:
+            cache.append(cache[-1] + self._indent_step)
 
-            elif key == 'device_ver':
-                return '12device_ver'
+        return cache[level]
 
-        return key
+    @property
+    def indent_str(self):
+        try:
+            return self._indent_cache[self.indentation_level]
+
+        except IndexError:
+            return self.indent_at(self.indentation_level)
+
+
+class InfoJSONEncoder(QMKJSONEncoder):
+    """Custom encoder to make info.json's a little nicer to work with.
+    """
+    sort_tables = _split_levels(_INFO_ORDER)
+
+    def encode_dict(self, obj, write):
+        """Encode info.json dictionaries.
+        """
+        if obj:
+            if self.indentation_level == 4:
+                # These are part of a layout, put them on a single line.
+                encode = self.encode
+                items = sorted(obj.items())
+                write("{ " + ", ".join([encode(key) + ": " + encode(element) for key, element in items]) + " }")
+
+            else:
+                self.write_dict_items(obj, write)
+        else:
+            write("{}")
 
 
 class KeymapJSONEncoder(QMKJSONEncoder):
     """Custom encoder to make keymap.json's a little nicer to work with.
     """
-    def encode_dict(self, obj):
+    sort_tables = _split_levels(_KEYMAP_ORDER)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._keycode_cache = {}
+
+    def encode_dict(self, obj, write):
         """Encode dictionary objects for keymap.json.
         """
         if obj:
-            self.indentation_level += 1
-            output_lines = [f"{self.indent_str}{json.dumps(key)}: {self.encode(value)}" for key, value in sorted(obj.items(), key=self.sort_dict)]
-            output = ',\n'.join(output_lines)
-            self.indentation_level -= 1
-
-            return f"{{\n{output}\n{self.indent_str}}}"
+            self.write_dict_items(obj, write)
 
         else:
-            return "{}"
+            write("{}")
 
-    def encode_list(self, obj):
+    def encode_list(self, obj, write):
         """Encode a list-like object.
         """
-        if self.indentation_level == 2:
-            indent_level = self.indentation_level + 1
-            # We have a list of keycodes
-            layer = [[]]
+        if not obj:
+            write("[]")
+
+        elif self.indentation_level == 2:
+            level = self.indentation_level
+            # Rows get the indent string repeated level + 1 times
+            row_indent = self.indent_at(level * (level + 1))
+            row_start = newline + row_indent
+            encode_to = self.encode_to
+            keycode_cache = self._keycode_cache
+            # We have a list of keycodes, written straight out row by row
+            separator = ''
+            write(self.indent_str + "[" + row_start)
 
             for key in obj:
                 if key == 'JSON_NEWLINE':
-                    layer.append([])
-                else:
-                    if isinstance(key, dict):
-                        # We have a macro
-
-                        # TODO: Add proper support for nicely formatting keymap.json macros
-                        layer[-1].append(f'{self.encode(key)}')
-                    else:
-                        layer[-1].append(f'"{key}"')
-
-            layer = [f"{self.indent_str*indent_level}{', '.join(row)}" for row in layer]
-
-            return f"{self.indent_str}[\n{newline.join(layer)}\n{self.indent_str*self.indentation_level}]"
-
-        elif self.primitives_only(obj):
-            return "[" + ", ".join(self.encode(element) for element in obj) + "]"
+                    write(row_start)
+                    separator = ''
+                    continue
 
-        else:
-            self.indentation_level += 1
-            output = [self.indent_str + self.encode(element) for element in obj]
-            self.indentation_level -= 1
-
-            return "[\n" + ",\n".join(output) + "\n" + self.indent_str + "]"
+                write(separator)
+                separator = ', '
 
-    def sort_dict(self, key):
-        """Sorts the hashes in a nice way.
-        """
-        key = key[0]
+                if type(key) is str:
+                    # Keymaps reuse a small set of keycodes, so quote each one once
+                    quoted = keycode_cache.get(key)
 
-        if self.indentation_level == 1:
-            if key == 'version':
-                return '00version'
+                    if quoted is None:
+                        quoted = '"' + key + '"'
 
-            elif key == 'author':
-                return '01author'
+                        if len(keycode_cache) < _KEY_CACHE_SIZE:
+                            keycode_cache[key] = quoted
 
-            elif key == 'notes':
-                return '02notes'
+                    write(quoted)
 
-            elif key == 'layers':
-                return '98layers'
+                elif isinstance(key, dict):
+                    # We have a macro
 
-            elif key == 'documentation':
-                return '99documentation'
+                    # TODO: Add proper support for nicely formatting keymap.json macros
+                    encode_to(key, write)
 
-            else:
-                return '50' + str(key)
+                else:
+                    write(f'"{key}"')
 
-        return key
+            write(newline + self.indent_at(level * level) + "]")
 
-from json.encoder import encode_basestring_ascii, encode_basestring, INFINITY, c_make_encoder, _make_iterencode
+        else:
+            super().encode_list(obj, write)
 
 class KLEJSONEncoder(json.JSONEncoder):
     """Modified the stock encoder to just turn float values that are whole numbers into integers. E.g. 1.0 -> 1
     """
     def iterencode(self, o, _one_shot=False):
+        if (_one_shot and c_make_encoder is not None
+                and self.indent is None):
+            # The C encoder has no floatstr hook, so collapse the floats beforehand and let it do the rest
+            return super().iterencode(self.collapse_floats(o, {} if self.check_circular else None), _one_shot)
+
         if self.check_circular:
             markers = {}
         else:
@@ -255,15 +431,58 @@ class KLEJSONEncoder(json.JSONEncoder):
             return text
 
 
-        if (_one_shot and c_make_encoder is not None
-                and self.indent is None):
-            _iterencode = c_make_encoder(
-                markers, self.default, _encoder, self.indent,
-                self.key_separator, self.item_separator, self.sort_keys,
-                self.skipkeys, self.allow_nan)
-        else:
-            _iterencode = _make_iterencode(
-                markers, self.default, _encoder, self.indent, floatstr,
-                self.key_separator, self.item_separator, self.sort_keys,
-                self.skipkeys, _one_shot)
-        return _iterencode(o, 0)
\ No newline at end of file
+        _iterencode = _make_iterencode(
+            markers, self.default, _encoder, self.indent, floatstr,
+            self.key_separator, self.item_separator, self.sort_keys,
+            self.skipkeys, _one_shot)
+        return _iterencode(o, 0)
+
+    def collapse_floats(self, o, markers=None):
+        """Returns a copy of o with whole number floats turned into integers, including dictionary keys.
+
+        markers holds the ids of the containers being collapsed, to catch circular references like the stock encoder.
+        """
+        scalars = _SCALAR_SET
+        collapse = self.collapse_floats
+        o_type = type(o)
+
+        if o_type in scalars:
+            return int(o) if o_type is float and o.is_integer() else o
+
+        if markers is not None:
+            marker = id(o)
+
+            if marker in markers:
+                raise ValueError("Circular reference detected")
+
+            markers[marker] = o
+
+        # Leaf values are handled inline, only containers (and subclasses of anything) recurse.
+        # Only float keys change, anything else is left to the stock encoder (and skipkeys).
+        if o_type is dict or o_type is OrderedDict:
+            o = {
+                (key if type(key) is str else int(key) if isinstance(key, float) and key.is_integer() else key):
+                (int(value) if type(value) is float and value.is_integer() else value if type(value) in scalars else collapse(value, markers))
+                for key, value in o.items()
+            }
+
+        elif o_type is list or o_type is tuple:
+            o = [int(value) if type(value) is float and value.is_integer() else value if type(value) in scalars else collapse(value, markers) for value in o]
+
+        # Subclasses of the types above
+        elif isinstance(o, dict):
+            o = {
+                (int(key) if isinstance(key, float) and key.is_integer() else key): collapse(value, markers)
+                for key, value in o.items()
+            }
+
+        elif isinstance(o, (list, tuple)):
+            o = [collapse(value, markers) for value in o]
+
+        elif isinstance(o, float):
+            o = int(o) if o.is_integer() else o
+
+        if markers is not None:
+            del markers[marker]
+
+        return o
\ No newline at end of file